@@ -51,8 +51,17 @@ def metrics_model(input_model, label_list, metrics='dice'):
     elif metrics == 'wl2':
         last_tensor = layers.WeightedL2Loss(target_value=5)([labels_gt, last_tensor])
 
+    # compute both losses, and switch from wl2 to dice during training (see layers.SwitchLosses)
+    # here the second output of input_model must be the tensor before the softmax
+    elif metrics == 'wl2_dice':
+        likelihood = input_model.outputs[1]
+        likelihood._keras_shape = tuple(likelihood.get_shape().as_list())
+        wl2_loss = layers.WeightedL2Loss(target_value=5)([labels_gt, likelihood])
+        dice_loss = layers.DiceLoss()([labels_gt, last_tensor])
+        last_tensor = layers.SwitchLosses(name='loss_switch')([wl2_loss, dice_loss])
+
     else:
-        raise Exception('metrics should either be "dice or "wl2, got {}'.format(metrics))
+        raise Exception('metrics should either be "dice", "wl2", or "wl2_dice", got {}'.format(metrics))
 
     # create the model and return
     model = Model(inputs=input_model.inputs, outputs=last_tensor)
@@ -311,7 +311,9 @@ def train_model(model,
                 model_dir,
                 metric_type,
                 path_checkpoint=None,
-                reinitialise_momentum=False):
+                reinitialise_momentum=False,
+                initial_epoch=None,
+                extra_callbacks=None):
 
     # prepare model and log folders
     utils.mkdir(model_dir)
@@ -326,6 +328,10 @@ def train_model(model,
     if metric_type == 'dice':
         callbacks.append(KC.TensorBoard(log_dir=log_dir, histogram_freq=0, write_graph=True, write_images=False))
 
+    # additional callbacks
+    if extra_callbacks is not None:
+        callbacks += extra_callbacks
+
     compile_model = True
     init_epoch = 0
     if path_checkpoint is not None:
@@ -339,6 +345,8 @@ def train_model(model,
             compile_model = False
         else:
             model.load_weights(path_checkpoint, by_name=True)
+    if initial_epoch is not None:
+        init_epoch = initial_epoch
 
     # compile
     if compile_model:
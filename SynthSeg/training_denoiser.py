@@ -16,16 +16,20 @@ License.
 
 # python imports
 import os
+import json
+import h5py
+import functools
 import numpy as np
 import tensorflow as tf
+import keras.backend as K
 from keras import models
+import keras.callbacks as KC
 from keras import layers as KL
 
 # project imports
 from SynthSeg import metrics_model as metrics
 from SynthSeg.training import train_model
 from SynthSeg.labels_to_image_model import get_shapes
-from SynthSeg.training_supervised import build_model_inputs
 
 # third-party imports
 from ext.lab2im import utils, layers
@@ -39,6 +43,7 @@ def training(list_paths_input_labels,
              target_segmentation_labels=None,
              subjects_prob=None,
              batchsize=1,
+             labels_shape=None,
              output_shape=None,
              scaling_bounds=.2,
              rotation_bounds=15,
@@ -48,6 +53,7 @@ def training(list_paths_input_labels,
              prob_erosion_dilation=0.3,
              min_erosion_dilation=4,
              max_erosion_dilation=5,
+             box_erosion_dilation=False,
              n_levels=5,
              nb_conv_per_level=2,
              conv_size=5,
@@ -59,7 +65,12 @@ def training(list_paths_input_labels,
              wl2_epochs=1,
              dice_epochs=50,
              steps_per_epoch=10000,
-             checkpoint=None):
+             checkpoint=None,
+             mixed_precision=False,
+             xla=False,
+             cache=False,
+             tfrecords_dir=None,
+             shuffle_buffer=16):
     """
 
     This function trains a UNet to segment MRI images with synthetic scans generated by sampling a GMM conditioned on
@@ -87,6 +98,8 @@ def training(list_paths_input_labels,
 
     # output-related parameters
     :param batchsize: (optional) number of images to generate per mini-batch. Default is 1.
+    :param labels_shape: (optional) shape of the input label maps, which must all have the same shape. Can be a
+    sequence or a 1d numpy array. Default is None, where it is read from the first input label map.
     :param output_shape: (optional) desired shape of the output image, obtained by randomly cropping the generated image
     Can be an integer (same size in all dimensions), a sequence, a 1d numpy array, or the path to a 1d numpy array.
     Default is None, where no cropping is performed.
@@ -116,6 +129,10 @@ def training(list_paths_input_labels,
     :param min_erosion_dilation: (optional) when prob_erosion_dilation is not zero, erosion and dilation of random
     coefficients are applied. Set the minimum erosion/dilation coefficient here.
     :param max_erosion_dilation: (optional) Set the maximum erosion/dilation coefficient here.
+    :param box_erosion_dilation: (optional) whether to erode/dilate the label maps with a cube of size 2*coef+1, rather
+    than with a ball of radius coef. This is much faster for large coefficients, but the cube reaches further along the
+    diagonals (and is about 2.5 times larger in volume), so this changes the degradation of the input labels.
+    Default is False.
 
     # ------------------------------------------ UNet architecture parameters ------------------------------------------
     :param n_levels: (optional) number of level for the Unet. Default is 5.
@@ -133,71 +150,162 @@ def training(list_paths_input_labels,
     :param wl2_epochs: (optional) number of epochs for which the network (except the soft-max layer) is trained with L2
     norm loss function. Default is 1.
     :param dice_epochs: (optional) number of epochs with the soft Dice loss function. Default is 50.
+    Both phases are run in a single training, so if dice_epochs is positive, models are saved as dice_xxx.h5 for all
+    wl2_epochs + dice_epochs epochs. Trainings can be resumed from wl2_xxx.h5 or dice_xxx.h5 models (see checkpoint).
     :param steps_per_epoch: (optional) number of steps per epoch. Default is 10000. Since no online validation is
     possible, this is equivalent to the frequency at which the models are saved.
-    :param checkpoint: (optional) path of an already saved model to load before starting the training.
+    :param checkpoint: (optional) path of an already saved model to load before starting the training. wl2_xxx.h5
+    models are resumed at epoch xxx (i.e. the remaining wl2 epochs are run before switching to dice). dice_xxx.h5
+    models trained without the wl2 phase (or saved by older versions of this function) are resumed at epoch
+    xxx + wl2_epochs. Models saved by older versions of this function are only used for their weights, as they converted
+    the input labels themselves, so the optimiser state is reinitialised in this case.
+    :param mixed_precision: (optional) whether to run the convolutions and matrix multiplications in float16 on GPUs
+    that support it (compute capability 7.0 or higher), while numerically sensitive operations (e.g. softmax, losses)
+    are kept in float32. This roughly halves the memory and time of the UNet, but no loss scaling is applied, so
+    monitor the loss for underflows when enabling it. This is a process-wide setting, so it is only enabled for the
+    duration of this function, after which the previous value is restored. If False, the current value is kept (i.e.
+    mixed precision can also be enabled by the caller). Default is False.
+    :param xla: (optional) whether to compile the training graph with XLA, which fuses successive element-wise
+    operations (e.g. activations, casts) into single kernels. Operations that XLA can't compile (e.g. the random
+    sampling of the augmentation layers) are left to TensorFlow. As for mixed_precision, this process-wide setting is
+    only enabled for the duration of this function, and is left unchanged if False. Default is False.
+    :param cache: (optional) whether to keep the training label maps in memory after they have been read once, which
+    avoids reading them from disk at every epoch. If the label maps don't fit in memory, this can also be the path of
+    a file where to cache them (preferably on a fast local disk), in which case they are only shuffled with a buffer
+    of shuffle_buffer subjects (see below). Default is False, where the label maps are read from disk at each epoch.
+    :param tfrecords_dir: (optional) path of a folder where the training label maps have been written as tfrecords
+    with write_tfrecords. If given, the label maps are read from these files, which is faster than decoding the
+    original label maps, and list_paths_input_labels and list_paths_target_labels can be None. Files are read in a
+    random order at each epoch, and records are only shuffled with a small buffer, so the label maps should be written
+    in several shards (see n_shards in write_tfrecords). subjects_prob must be in the order given to write_tfrecords.
+    :param shuffle_buffer: (optional) number of label maps held in memory to shuffle them when they are cached in a
+    file, or read from tfrecords. In these cases, label maps are only mixed with the next shuffle_buffer ones, so
+    list_paths_input_labels should not be sorted by any meaningful criterion (e.g. site or age). This is not used if
+    the label maps are read from disk (cache=False) or cached in memory (cache=True), where they are fully shuffled.
+    Default is 16.
     """
 
     # check epochs
     assert (wl2_epochs > 0) | (dice_epochs > 0), \
         'either wl2_epochs or dice_epochs must be positive, had {0} and {1}'.format(wl2_epochs, dice_epochs)
 
-    # prepare data files
-    input_label_list, _ = utils.get_list_labels(label_list=input_segmentation_labels)
-    if target_segmentation_labels is None:
-        target_label_list = input_label_list
-    else:
-        target_label_list, _ = utils.get_list_labels(label_list=target_segmentation_labels)
-    n_labels = np.size(target_label_list)
-
-    # create augmentation model
-    labels_shape, _, _, _, _, _ = utils.get_volume_info(list_paths_input_labels[0], aff_ref=np.eye(4))
-    augmentation_model = build_augmentation_model(labels_shape,
-                                                  input_label_list,
-                                                  crop_shape=output_shape,
-                                                  output_div_by_n=2 ** n_levels,
-                                                  scaling_bounds=scaling_bounds,
-                                                  rotation_bounds=rotation_bounds,
-                                                  shearing_bounds=shearing_bounds,
-                                                  nonlin_std=nonlin_std,
-                                                  nonlin_scale=nonlin_scale,
-                                                  prob_erosion_dilation=prob_erosion_dilation,
-                                                  min_erosion_dilation=min_erosion_dilation,
-                                                  max_erosion_dilation=max_erosion_dilation)
-    unet_input_shape = augmentation_model.output[0].get_shape().as_list()[1:]
-
-    # prepare the segmentation model
-    l2l_model = nrn_models.unet(input_model=augmentation_model,
-                                input_shape=unet_input_shape,
-                                nb_labels=n_labels,
-                                nb_levels=n_levels,
-                                nb_conv_per_level=nb_conv_per_level,
-                                conv_size=conv_size,
-                                nb_features=unet_feat_count,
-                                feat_mult=feat_multiplier,
-                                activation=activation,
-                                batch_norm=-1,
-                                skip_n_concatenations=skip_n_concatenations,
-                                name='l2l')
-
-    # input generator
-    model_inputs = build_model_inputs(path_inputs=list_paths_input_labels,
-                                      path_outputs=list_paths_target_labels,
+    # enable automatic mixed precision in the training graph. This is a process-wide setting (which only affects the
+    # Keras sessions created afterwards), so the previous value is restored at the end of the training
+    previous_mixed_precision = tf.config.optimizer.get_experimental_options().get('auto_mixed_precision', False)
+    if mixed_precision:
+        tf.config.optimizer.set_experimental_options({'auto_mixed_precision': True})
+
+    # enable XLA compilation of the training graph (also a process-wide setting, restored at the end of the training)
+    previous_xla = tf.config.optimizer.get_jit()
+    if xla:
+        tf.config.optimizer.set_jit(True)
+
+    try:
+
+        # prepare data files
+        input_label_list = _cached_label_list(input_segmentation_labels)
+        if target_segmentation_labels is None:
+            target_label_list = input_label_list
+        else:
+            target_label_list = _cached_label_list(target_segmentation_labels)
+        n_labels = np.size(target_label_list)
+
+        # look-up table to convert the input labels to [0, ... N-1]
+        input_label_list = np.unique(input_label_list).astype('int32')
+        assert 0 in input_label_list, 'input_segmentation_labels should contain the background label 0'
+        input_lut = utils.get_mapping_lut(input_label_list)
+
+        # smallest integer types that can hold the input labels (once converted to [0, ... N-1]) and the target labels
+        dtype_input = np.min_scalar_type(len(input_label_list) - 1).name
+        dtype_target = np.min_scalar_type(np.max(target_label_list)).name
+
+        # create augmentation model
+        if (labels_shape is None) and (tfrecords_dir is not None):
+            labels_shape = np.load(os.path.join(tfrecords_dir, 'tfrecords_info.npz'))['labels_shape']
+        elif labels_shape is None:
+            labels_shape, _, _, _, _, _ = utils.get_volume_info(list_paths_input_labels[0], aff_ref=np.eye(4))
+        labels_shape = utils.reformat_to_list(labels_shape, dtype='int')
+        augmentation_model = build_augmentation_model(labels_shape,
+                                                      input_label_list,
+                                                      crop_shape=output_shape,
+                                                      output_div_by_n=2 ** n_levels,
+                                                      scaling_bounds=scaling_bounds,
+                                                      rotation_bounds=rotation_bounds,
+                                                      shearing_bounds=shearing_bounds,
+                                                      nonlin_std=nonlin_std,
+                                                      nonlin_scale=nonlin_scale,
+                                                      prob_erosion_dilation=prob_erosion_dilation,
+                                                      min_erosion_dilation=min_erosion_dilation,
+                                                      max_erosion_dilation=max_erosion_dilation,
+                                                      box_erosion_dilation=box_erosion_dilation,
+                                                      dtype_input=dtype_input,
+                                                      dtype_target=dtype_target)
+        unet_input_shape = augmentation_model.output[0].get_shape().as_list()[1:]
+
+        # prepare the segmentation model
+        l2l_model = nrn_models.unet(input_model=augmentation_model,
+                                    input_shape=unet_input_shape,
+                                    nb_labels=n_labels,
+                                    nb_levels=n_levels,
+                                    nb_conv_per_level=nb_conv_per_level,
+                                    conv_size=conv_size,
+                                    nb_features=unet_feat_count,
+                                    feat_mult=feat_multiplier,
+                                    activation=activation,
+                                    batch_norm=-1,
+                                    skip_n_concatenations=skip_n_concatenations,
+                                    name='l2l')
+
+        # input generator
+        dataset = build_input_dataset(list_paths_input_labels,
+                                      list_paths_target_labels,
+                                      labels_shape,
+                                      input_lut,
+                                      dtype_input=dtype_input,
+                                      dtype_target=dtype_target,
                                       batchsize=batchsize,
                                       subjects_prob=subjects_prob,
-                                      dtype_input='int32')
-    input_generator = utils.build_training_generator(model_inputs, batchsize)
-
-    # pre-training with weighted L2, input is fit to the softmax rather than the probabilities
-    if wl2_epochs > 0:
-        wl2_model = models.Model(l2l_model.inputs, [l2l_model.get_layer('l2l_likelihood').output])
-        wl2_model = metrics.metrics_model(wl2_model, target_label_list, 'wl2')
-        train_model(wl2_model, input_generator, lr, wl2_epochs, steps_per_epoch, model_dir, 'wl2', checkpoint)
-        checkpoint = os.path.join(model_dir, 'wl2_%03d.h5' % wl2_epochs)
-
-    # fine-tuning with dice metric
-    dice_model = metrics.metrics_model(l2l_model, target_label_list, 'dice')
-    train_model(dice_model, input_generator, lr, dice_epochs, steps_per_epoch, model_dir, 'dice', checkpoint)
+                                      cache=cache,
+                                      tfrecords_dir=tfrecords_dir,
+                                      shuffle_buffer=shuffle_buffer)
+        input_generator = utils.build_training_generator(([t.numpy() for t in pair] for pair in dataset), batchsize)
+
+        # pre-training with weighted L2 (input is fit to the softmax rather than the probabilities), then fine-tuning
+        # with dice metric. Both losses are computed by the same model, which switches to dice after wl2_epochs.
+        # Checkpoints whose architecture differs from the trained model are not reloaded as they were saved, but only
+        # their weights are loaded in the new model. This is the case for models saved by older versions of this
+        # function (which converted the input labels themselves, while they are now converted in the input pipeline),
+        # and for models with/without the loss switch when training with/without both losses.
+        init_epoch = None
+        reload_weights_only = False
+        if checkpoint is not None:
+            fused = (wl2_epochs > 0) & (dice_epochs > 0)
+            checkpoint_layers = get_checkpoint_layers(checkpoint)
+            old_checkpoint = checkpoint_layers.get('noisy_labels_out') != 'OneHot'
+            reload_weights_only = old_checkpoint | (fused != ('loss_switch' in checkpoint_layers))
+            checkpoint_name = os.path.basename(checkpoint)
+            if checkpoint_name.startswith('wl2_'):
+                init_epoch = int(checkpoint_name[4:-3])
+            elif checkpoint_name.startswith('dice_') & fused & ('loss_switch' not in checkpoint_layers):
+                init_epoch = int(checkpoint_name[5:-3]) + wl2_epochs  # epochs were counted from the start of dice
+        callbacks = None
+        if (wl2_epochs > 0) & (dice_epochs > 0):
+            l2l_model = models.Model(l2l_model.inputs, [l2l_model.output, l2l_model.get_layer('l2l_likelihood').output])
+            l2l_model = metrics.metrics_model(l2l_model, target_label_list, 'wl2_dice')
+            callbacks = [SwitchLossesCallback(switch_epoch=wl2_epochs, layer_name='loss_switch')]
+        elif wl2_epochs > 0:
+            l2l_model = models.Model(l2l_model.inputs, [l2l_model.get_layer('l2l_likelihood').output])
+            l2l_model = metrics.metrics_model(l2l_model, target_label_list, 'wl2')
+        else:
+            l2l_model = metrics.metrics_model(l2l_model, target_label_list, 'dice')
+        metric_type = 'dice' if dice_epochs > 0 else 'wl2'
+        train_model(l2l_model, input_generator, lr, wl2_epochs + dice_epochs, steps_per_epoch, model_dir, metric_type,
+                    checkpoint, reinitialise_momentum=reload_weights_only, initial_epoch=init_epoch,
+                    extra_callbacks=callbacks)
+
+    finally:
+        tf.config.optimizer.set_experimental_options({'auto_mixed_precision': previous_mixed_precision})
+        tf.config.optimizer.set_jit(previous_xla)
 
 
 def build_augmentation_model(labels_shape,
@@ -212,7 +320,10 @@ def build_augmentation_model(labels_shape,
                              nonlin_scale=.0625,
                              prob_erosion_dilation=0.3,
                              min_erosion_dilation=4,
-                             max_erosion_dilation=7):
+                             max_erosion_dilation=7,
+                             box_erosion_dilation=False,
+                             dtype_input='int32',
+                             dtype_target='int32'):
 
     # reformat resolutions and get shapes
     labels_shape = utils.reformat_to_list(labels_shape)
@@ -223,8 +334,13 @@ def build_augmentation_model(labels_shape,
     crop_shape, _ = get_shapes(labels_shape, crop_shape, np.array([1]*n_dims), np.array([1]*n_dims), output_div_by_n)
 
     # define model inputs
-    net_input = KL.Input(shape=labels_shape + [1], name='l2l_noisy_labels_input', dtype='int32')
-    target_input = KL.Input(shape=labels_shape + [1], name='l2l_target_input', dtype='int32')
+    net_input = KL.Input(shape=labels_shape + [1], name='l2l_noisy_labels_input', dtype=dtype_input)
+    target_input = KL.Input(shape=labels_shape + [1], name='l2l_target_input', dtype=dtype_target)
+
+    # the smaller input types are only used in the input pipeline and for the host-to-device copies, as the following
+    # layers compute in float32 (deformation) or have no GPU kernels for small integer types (gather in cropping)
+    noisy_labels = layers.CastLabels('int32', remove_channel=False)(net_input)
+    target = layers.CastLabels('int32', remove_channel=False)(target_input)
 
     # deform labels
     noisy_labels, target = layers.RandomSpatialDeformation(scaling_bounds=scaling_bounds,
@@ -233,24 +349,278 @@ def build_augmentation_model(labels_shape,
                                                            translation_bounds=translation_bounds,
                                                            nonlin_std=nonlin_std,
                                                            nonlin_scale=nonlin_scale,
-                                                           inter_method='nearest')([net_input, target_input])
+                                                           inter_method='nearest')([noisy_labels, target])
 
     # cropping
     if crop_shape != labels_shape:
         noisy_labels, target = layers.RandomCrop(crop_shape)([noisy_labels, target])
 
     # random erosion
-    if prob_erosion_dilation > 0:
+    if (prob_erosion_dilation > 0) & box_erosion_dilation:
+        noisy_labels = layers.RandomBoxDilationErosion(min_erosion_dilation,
+                                                       max_erosion_dilation,
+                                                       prob=prob_erosion_dilation)(noisy_labels)
+    elif prob_erosion_dilation > 0:
         noisy_labels = layers.RandomDilationErosion(min_erosion_dilation,
                                                     max_erosion_dilation,
                                                     prob=prob_erosion_dilation)(noisy_labels)
 
-    # convert input labels (i.e. noisy_labels) to [0, ... N-1] and make them one-hot
-    noisy_labels = layers.ConvertLabels(np.unique(segmentation_labels))(noisy_labels)
-    target = KL.Lambda(lambda x: tf.cast(x[..., 0], 'int32'), name='labels_out')(target)
-    noisy_labels = KL.Lambda(lambda x: tf.one_hot(x[0][..., 0], depth=n_labels),
-                             name='noisy_labels_out')([noisy_labels, target])
+    # make input labels one-hot (noisy_labels are already converted to [0, ... N-1] in the input pipeline)
+    target = layers.CastLabels('int32', name='labels_out')(target)
+    noisy_labels = layers.OneHot(n_labels, name='noisy_labels_out')([noisy_labels, target])
 
     # build model and return
     brain_model = models.Model(inputs=[net_input, target_input], outputs=[noisy_labels, target])
     return brain_model
+
+
+def build_input_dataset(list_paths_input_labels,
+                        list_paths_target_labels,
+                        labels_shape,
+                        lut,
+                        dtype_input='int32',
+                        dtype_target='int32',
+                        batchsize=1,
+                        subjects_prob=None,
+                        cache=False,
+                        tfrecords_dir=None,
+                        shuffle_buffer=16):
+    """Build a tf.data pipeline that yields batches of (noisy labels, target labels), both of shape
+    [batchsize, *labels_shape, 1]. Pairs of label maps are read from disk in parallel, and batches are prefetched in
+    the background, so that loading the label maps overlaps with the training steps.
+    The noisy labels are converted to [0, ... N-1] with the given look-up table (see utils.get_mapping_lut), so that
+    this conversion is done on the CPU while the previous training step is running. Noisy and target labels are then
+    cast to dtype_input and dtype_target, which can be smaller integer types (e.g. uint8) to reduce the size of the
+    cache, of the prefetched batches, and of the host-to-device copies.
+    If cache is True, the loaded pairs are kept in memory after the first pass over the data, so that each label map
+    is only read once, and they are fully shuffled at each epoch. cache can also be the path of a file where to write
+    them, if they don't fit in memory, in which case they are shuffled with a buffer of shuffle_buffer pairs, which is
+    the number of pairs held in memory at once.
+    If tfrecords_dir is given, the label maps are read from the tfrecords files written by write_tfrecords in this
+    folder, instead of being decoded from list_paths_input_labels and list_paths_target_labels (which can be None).
+    The order of these files is shuffled at each epoch, and pairs are then shuffled with a buffer of shuffle_buffer
+    pairs, so that only a few decoded pairs are held in memory at once."""
+
+    # read pairs of label maps in parallel
+    def load_pair(path_input, path_target):
+        noisy_labels = utils.load_volume(path_input.decode(), aff_ref=np.eye(4), dtype='int32')
+        target = utils.load_volume(path_target.decode(), aff_ref=np.eye(4), dtype='int32')
+        return utils.add_axis(noisy_labels, -1), utils.add_axis(target, -1)
+
+    # subjects_prob is enforced by rejecting subjects with the relevant probability
+    n_subjects = len(list_paths_input_labels) if list_paths_input_labels is not None else None
+    if subjects_prob is not None:
+        subjects_prob = np.array(utils.reformat_to_list(subjects_prob, load_as_numpy=True, dtype='float'))
+        subjects_prob = tf.convert_to_tensor(subjects_prob / np.max(subjects_prob), dtype='float32')
+
+    def keep_subject(idx, *args):
+        return tf.random.uniform([]) < tf.gather(subjects_prob, idx)
+
+    shape = utils.reformat_to_list(labels_shape) + [1]
+    if tfrecords_dir is None:
+
+        # if we don't cache the label maps, subjects are shuffled/picked before loading, so that we only shuffle indices
+        dataset = tf.data.Dataset.from_tensor_slices((np.arange(n_subjects), list_paths_input_labels,
+                                                      list_paths_target_labels))
+        if not cache:
+            dataset = dataset.shuffle(n_subjects).repeat()
+            if subjects_prob is not None:
+                dataset = dataset.filter(keep_subject)
+        dataset = dataset.interleave(
+            lambda idx, path_input, path_target: tf.data.Dataset.from_tensors(
+                (idx,) + tuple(tf.numpy_function(load_pair, [path_input, path_target], [tf.int32, tf.int32]))),
+            cycle_length=tf.data.experimental.AUTOTUNE,
+            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+        # numpy_function loses the static shapes, so we set them back
+        def set_shape(idx, noisy_labels, target):
+            noisy_labels.set_shape(shape)
+            target.set_shape(shape)
+            return idx, noisy_labels, target
+
+        dataset = dataset.map(set_shape)
+
+    else:
+
+        # read pre-decoded label maps from tfrecords files (see write_tfrecords)
+        features = {'idx': tf.io.FixedLenFeature([], tf.int64),
+                    'noisy_labels': tf.io.FixedLenFeature([], tf.string),
+                    'target': tf.io.FixedLenFeature([], tf.string)}
+
+        def parse_pair(record):
+            example = tf.io.parse_single_example(record, features)
+            noisy_labels = tf.reshape(tf.io.decode_raw(example['noisy_labels'], tf.int32), shape)
+            target = tf.reshape(tf.io.decode_raw(example['target'], tf.int32), shape)
+            return example['idx'], noisy_labels, target
+
+        # number of subjects and compression of the files (see write_tfrecords)
+        tfrecords_info = np.load(os.path.join(tfrecords_dir, 'tfrecords_info.npz'))
+        n_subjects = int(tfrecords_info['n_subjects'])
+        compression = str(tfrecords_info['compression'])
+
+        # the order of the files is shuffled at each epoch, and records are read from several files at once, so that
+        # pairs only need to be shuffled with a small buffer afterwards (see below)
+        dataset = tf.data.Dataset.list_files(os.path.join(tfrecords_dir, '*.tfrecord'), shuffle=True)
+        if not cache:
+            dataset = dataset.repeat()
+        dataset = dataset.interleave(lambda path: tf.data.TFRecordDataset(path, compression_type=compression),
+                                     cycle_length=tf.data.experimental.AUTOTUNE,
+                                     num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.map(parse_pair, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    # convert noisy labels to [0, ... N-1], and cast labels to the requested types. Values that are not in the look-up
+    # table are mapped to background (like in layers.ConvertLabels), by clipping them to an extra zero entry. Similarly,
+    # target values that don't fit in dtype_target are set to background, rather than wrapping around to another label
+    lut = tf.convert_to_tensor(np.append(lut, 0).astype(dtype_input))
+    max_lut_idx = lut.get_shape().as_list()[0] - 1
+    target_min = max(np.iinfo(dtype_target).min, np.iinfo('int32').min)
+    target_max = min(np.iinfo(dtype_target).max, np.iinfo('int32').max)
+
+    def convert_labels(idx, noisy_labels, target):
+        noisy_labels = tf.gather(lut, tf.clip_by_value(noisy_labels, 0, max_lut_idx))
+        target = tf.where((target < target_min) | (target > target_max), tf.zeros_like(target), target)
+        return idx, noisy_labels, tf.cast(target, dtype_target)
+
+    dataset = dataset.map(convert_labels, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    # cached pairs (or pairs read from tfrecords) can't be picked by index, so they are repeated in their stored order,
+    # and shuffled afterwards. Pairs cached in memory are fully shuffled, as the shuffle buffer only references them.
+    # Otherwise, we use a buffer of shuffle_buffer pairs, which bounds the memory used by the pipeline, but only mixes
+    # pairs with their neighbours, so the stored order should not be sorted (e.g. by site or by age).
+    if cache:
+        dataset = dataset.cache(cache if isinstance(cache, str) else '').repeat()
+    if cache or (tfrecords_dir is not None):
+        if subjects_prob is not None:
+            dataset = dataset.filter(keep_subject)
+        full_shuffle = (cache is True) and (n_subjects is not None)
+        dataset = dataset.shuffle(n_subjects if full_shuffle else shuffle_buffer)
+    dataset = dataset.map(lambda idx, noisy_labels, target: (noisy_labels, target))
+
+    # batch and prefetch
+    dataset = dataset.batch(batchsize, drop_remainder=True)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    # subjects are sampled at random anyway, so we let the pipeline return pairs as soon as they are read
+    options = tf.data.Options()
+    options.experimental_deterministic = False
+
+    # fuse successive maps (and the last map with the batch), and give the pipeline its own threads
+    options.experimental_optimization.map_fusion = True
+    options.experimental_optimization.map_and_batch_fusion = True
+    options.experimental_threading.private_threadpool_size = os.cpu_count()
+    dataset = dataset.with_options(options)
+
+    return dataset
+
+
+def write_tfrecords(list_paths_input_labels,
+                    list_paths_target_labels,
+                    tfrecords_dir,
+                    n_shards=None,
+                    compression='ZLIB'):
+    """This function writes pairs of input/target label maps in tfrecords files, which can then be used for training
+    (see tfrecords_dir in training) to avoid decoding the label maps at each epoch.
+    The label maps are aligned to the identity affine matrix, and are stored as int32 in n_shards files.
+    Their shape, their number, and the compression of the files are saved in the same folder (tfrecords_info.npz), so
+    that training doesn't need the original label maps.
+    :param list_paths_input_labels: list of all the paths of the input label maps.
+    :param list_paths_target_labels: list of all the paths of the output label maps, in the same order.
+    :param tfrecords_dir: path of the folder where the tfrecords files will be written.
+    :param n_shards: (optional) number of files over which to split the label maps. Since files are read in a random
+    order during training, but records are only shuffled with a small buffer, use at least a few shards.
+    Default is None, where label maps are split over min(16, number of label maps) files.
+    :param compression: (optional) compression of the tfrecords files, can be 'ZLIB', 'GZIP', or '' for uncompressed
+    files. Uncompressed pairs take 8 bytes per voxel (two int32 maps), so they should only be used for small datasets.
+    Default is 'ZLIB'.
+    """
+
+    assert len(list_paths_input_labels) == len(list_paths_target_labels), \
+        'there should be as many input as target label maps'
+    n_subjects = len(list_paths_input_labels)
+    if n_shards is None:
+        n_shards = min(16, n_subjects)
+    elif n_shards == 1:
+        print('WARNING: label maps are written in a single tfrecords file, so they will only be shuffled with a small '
+              'buffer during training (see shuffle_buffer in training)')
+    utils.mkdir(tfrecords_dir)
+    writers = [tf.io.TFRecordWriter(os.path.join(tfrecords_dir, 'labels_%03d.tfrecord' % i), options=compression)
+               for i in range(n_shards)]
+
+    labels_shape = None
+    loop_info = utils.LoopInfo(len(list_paths_input_labels), 10, 'writing', True)
+    for idx, (path_input, path_target) in enumerate(zip(list_paths_input_labels, list_paths_target_labels)):
+        loop_info.update(idx)
+        noisy_labels = utils.load_volume(path_input, aff_ref=np.eye(4), dtype='int32')
+        target = utils.load_volume(path_target, aff_ref=np.eye(4), dtype='int32')
+        if idx == 0:
+            labels_shape = noisy_labels.shape
+        assert noisy_labels.shape == target.shape == labels_shape, \
+            'all label maps should have the same shape, had {0} for {1}'.format(noisy_labels.shape, path_input)
+        features = {'idx': tf.train.Feature(int64_list=tf.train.Int64List(value=[idx])),
+                    'noisy_labels': tf.train.Feature(bytes_list=tf.train.BytesList(value=[noisy_labels.tobytes()])),
+                    'target': tf.train.Feature(bytes_list=tf.train.BytesList(value=[target.tobytes()]))}
+        example = tf.train.Example(features=tf.train.Features(feature=features))
+        writers[idx % n_shards].write(example.SerializeToString())
+
+    for writer in writers:
+        writer.close()
+    np.savez(os.path.join(tfrecords_dir, 'tfrecords_info.npz'),
+             labels_shape=np.array(labels_shape), n_subjects=n_subjects, compression=compression)
+
+
+def _cached_label_list(label_list):
+    """Same as utils.get_list_labels(label_list=label_list)[0], except that label lists given as paths are cached, so
+    that they are not read again when training is called several times in the same session (e.g. hyperparameter
+    sweeps). Paths are cached along with their modification time, so that edited files are read again.
+    :param label_list: a sequence, a 1d numpy array, or the path to a 1d numpy array.
+    :return: the label list as a 1d numpy array (read-only if label_list is a path).
+    """
+    if isinstance(label_list, str):
+        return _read_label_list(label_list, os.path.getmtime(label_list))
+    return utils.get_list_labels(label_list=label_list)[0]
+
+
+@functools.lru_cache(maxsize=None)
+def _read_label_list(path_label_list, mtime):
+    """Cached call to utils.get_list_labels for a path. mtime is only used as part of the cache key."""
+    label_list, _ = utils.get_list_labels(label_list=path_label_list)
+    label_list.flags.writeable = False
+    return label_list
+
+
+def get_checkpoint_layers(path_checkpoint):
+    """Read the layers of a model saved by Keras, without building it.
+    :param path_checkpoint: path of a model saved as a .h5 file.
+    :return: a dictionary mapping the names of all the layers (including those of nested models) to their class names.
+    """
+
+    def get_layers(config):
+        checkpoint_layers = dict()
+        for layer in config['config']['layers']:
+            checkpoint_layers[layer['config']['name']] = layer['class_name']
+            if 'layers' in layer['config']:
+                checkpoint_layers.update(get_layers(layer))
+        return checkpoint_layers
+
+    with h5py.File(path_checkpoint, 'r') as f:
+        model_config = f.attrs.get('model_config')
+    if model_config is None:
+        return dict()  # only weights were saved
+    if isinstance(model_config, bytes):
+        model_config = model_config.decode('utf-8')
+    return get_layers(json.loads(model_config))
+
+
+class SwitchLossesCallback(KC.Callback):
+    """Set the switch of a SwitchLosses layer at the beginning of each epoch, such that the model is trained with the
+    first loss until switch_epoch, and with the second loss afterwards.
+    The layer is fetched from the trained model at each epoch, so this also works if the model has been reloaded from a
+    checkpoint in train_model."""
+
+    def __init__(self, switch_epoch, layer_name='loss_switch'):
+        self.switch_epoch = switch_epoch
+        self.layer_name = layer_name
+        super(SwitchLossesCallback, self).__init__()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        K.set_value(self.model.get_layer(self.layer_name).switch, float(epoch >= self.switch_epoch))
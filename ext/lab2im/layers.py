@@ -12,12 +12,16 @@ This file regroups several custom keras layers used in the generation model:
     - IntensityAugmentation,
     - DiceLoss,
     - WeightedL2Loss,
+    - SwitchLosses,
     - ResetValuesToZero,
     - ConvertLabels,
+    - OneHot,
+    - CastLabels,
     - PadAroundCentre,
     - MaskEdges
     - ImageGradients
     - RandomDilationErosion
+    - RandomBoxDilationErosion
 
 
 If you use this code, please cite the first SynthSeg paper:
@@ -103,6 +107,10 @@ class RandomSpatialDeformation(Layer):
         self.n_dims = None
         self.small_shape = None
 
+        # sub-layers, which are only built once
+        self.elastic_layers = None
+        self.transformers = None
+
         # deformation attributes
         self.scaling_bounds = scaling_bounds
         self.rotation_bounds = rotation_bounds
@@ -150,10 +158,16 @@ class RandomSpatialDeformation(Layer):
         if self.apply_elastic_trans:
             self.small_shape = utils.get_resample_shape(self.inshape[:self.n_dims],
                                                         self.nonlin_scale, self.n_dims)
+            # the small field is resized to half size (for smoother SVF), integrated, and resized to full image size
+            resize_shape = [max(int(self.inshape[i] / 2), self.small_shape[i]) for i in range(self.n_dims)]
+            self.elastic_layers = [nrn_layers.Resize(size=resize_shape, interp_method='linear'),
+                                   nrn_layers.VecInt(),
+                                   nrn_layers.Resize(size=self.inshape[:self.n_dims], interp_method='linear')]
         else:
             self.small_shape = None
 
         self.inter_method = utils.reformat_to_list(self.inter_method, length=self.n_inputs, dtype='str')
+        self.transformers = [nrn_layers.SpatialTransformer(m) for m in self.inter_method]
 
         self.built = True
         super(RandomSpatialDeformation, self).build(input_shape)
@@ -190,21 +204,18 @@ class RandomSpatialDeformation(Layer):
             elastic_trans = tf.random.normal(trans_shape, stddev=trans_std)
 
             # reshape this field to half size (for smoother SVF), integrate it, and reshape to full image size
-            resize_shape = [max(int(self.inshape[i] / 2), self.small_shape[i]) for i in range(self.n_dims)]
-            elastic_trans = nrn_layers.Resize(size=resize_shape, interp_method='linear')(elastic_trans)
-            elastic_trans = nrn_layers.VecInt()(elastic_trans)
-            elastic_trans = nrn_layers.Resize(size=self.inshape[:self.n_dims], interp_method='linear')(elastic_trans)
+            for layer in self.elastic_layers:
+                elastic_trans = layer(elastic_trans)
             list_trans.append(elastic_trans)
 
         # apply deformations and return tensors with correct dtype
         if self.apply_affine_trans | self.apply_elastic_trans:
             if self.prob == 1:
-                inputs = [nrn_layers.SpatialTransformer(m)([v] + list_trans) for (m, v) in
-                          zip(self.inter_method, inputs)]
+                inputs = [transformer([v] + list_trans) for (transformer, v) in zip(self.transformers, inputs)]
             else:
                 rand_trans = tf.squeeze(K.less(tf.random.uniform([1], 0, 1), self.prob))
-                inputs = [K.switch(rand_trans, nrn_layers.SpatialTransformer(m)([v] + list_trans), v)
-                          for (m, v) in zip(self.inter_method, inputs)]
+                inputs = [K.switch(rand_trans, transformer([v] + list_trans), v)
+                          for (transformer, v) in zip(self.transformers, inputs)]
         return [tf.cast(v, t) for (t, v) in zip(types, inputs)]
 
 
@@ -248,23 +259,21 @@ class RandomCrop(Layer):
 
     def call(self, inputs, **kwargs):
 
-        # if one input only is provided, performs the cropping directly
+        # reformat inputs
         if not self.several_inputs:
-            return tf.map_fn(self._single_slice, inputs, dtype=inputs.dtype)
+            inputs = [inputs]
 
-        # otherwise we concatenate all inputs before cropping, so that they are all cropped at the same location
-        else:
-            types = [v.dtype for v in inputs]
-            inputs = tf.concat([tf.cast(v, 'float32') for v in inputs], axis=-1)
-            inputs = tf.map_fn(self._single_slice, inputs, dtype=tf.float32)
-            inputs = tf.split(inputs, self.list_n_channels, axis=-1)
-            return [tf.cast(v, t) for (t, v) in zip(types, inputs)]
-
-    def _single_slice(self, vol):
-        crop_idx = tf.cast(tf.random.uniform([self.n_dims], 0, np.array(self.crop_max_val), 'float32'), dtype='int32')
-        crop_idx = tf.concat([crop_idx, tf.zeros([1], dtype='int32')], axis=0)
-        crop_size = tf.convert_to_tensor(self.crop_shape + [-1], dtype='int32')
-        return tf.slice(vol, begin=crop_idx, size=crop_size)
+        # sample cropping indices for each element of the batch, these are shared by all inputs
+        batchsize = tf.split(tf.shape(inputs[0]), [1, -1])[0]
+        idx_shape = tf.concat([batchsize, tf.convert_to_tensor([self.n_dims], dtype='int32')], axis=0)
+        crop_idx = tf.cast(tf.random.uniform(idx_shape, 0, np.array(self.crop_max_val), 'float32'), dtype='int32')
+
+        # crop all the elements of the batch at once, by gathering the cropped indices along each axis
+        for i in range(self.n_dims):
+            axis_idx = tf.expand_dims(crop_idx[:, i], -1) + tf.range(self.crop_shape[i])
+            inputs = [tf.gather(v, axis_idx, axis=i + 1, batch_dims=1) for v in inputs]
+
+        return inputs if self.several_inputs else inputs[0]
 
     def compute_output_shape(self, input_shape):
         output_shape = [tuple([None] + self.crop_shape + [v]) for v in self.list_n_channels]
@@ -1406,6 +1415,42 @@ class WeightedL2Loss(Layer):
         return [[]]
 
 
+class SwitchLosses(Layer):
+    """This layer returns one of two input losses, depending on the value of a non-trainable weight (switch).
+    This enables to change the loss of a model during training (e.g. with a callback calling
+    K.set_value(layer.switch, 1)) without having to rebuild or recompile it. Since the switch is a weight, its value is
+    saved and restored with the model.
+    loss = SwitchLosses()([loss_1, loss_2]) returns loss_1 if switch is 0, and loss_2 if switch is 1.
+
+    :param initial_value: (optional) initial value of the switch. Default is 0, where the first loss is returned.
+    """
+
+    def __init__(self, initial_value=0, **kwargs):
+        self.initial_value = initial_value
+        self.switch = None
+        super(SwitchLosses, self).__init__(**kwargs)
+
+    def get_config(self):
+        config = super().get_config()
+        config["initial_value"] = self.initial_value
+        return config
+
+    def build(self, input_shape):
+        assert len(input_shape) == 2, 'SwitchLosses expects 2 inputs.'
+        self.switch = self.add_weight(name='switch',
+                                      shape=(),
+                                      initializer=keras.initializers.Constant(self.initial_value),
+                                      trainable=False)
+        self.built = True
+        super(SwitchLosses, self).build(input_shape)
+
+    def call(self, inputs, **kwargs):
+        return K.switch(K.greater(self.switch, 0.5), inputs[1], inputs[0])
+
+    def compute_output_shape(self, input_shape):
+        return [[]]
+
+
 class CrossEntropyLoss(Layer):
     """This layer computes the cross-entropy loss between two tensors.
     These tensors are expected to have the same shape (one-hot encoding) [batch, size_dim1, ..., size_dimN, n_labels].
@@ -1680,6 +1725,63 @@ class ConvertLabels(Layer):
         return tf.gather(self.lut, tf.cast(inputs, dtype='int32'))
 
 
+class OneHot(Layer):
+    """Convert a label map of shape [batchsize, shape_dim1, ..., shape_dimn, 1] with values in [0, ... depth-1] to its
+    one-hot encoding of shape [batchsize, shape_dim1, ..., shape_dimn, depth].
+    If a list of tensors is given, only the first one is encoded, the others are only used to keep them connected to
+    the model (e.g. when plugging this model to other models).
+
+    :param depth: number of labels (i.e. number of channels of the one-hot encoding).
+    """
+
+    def __init__(self, depth, **kwargs):
+        self.depth = depth
+        super(OneHot, self).__init__(**kwargs)
+
+    def get_config(self):
+        config = super().get_config()
+        config["depth"] = self.depth
+        return config
+
+    def call(self, inputs, **kwargs):
+        if isinstance(inputs, list):
+            inputs = inputs[0]
+        return tf.one_hot(tf.cast(inputs[..., 0], dtype='int32'), depth=self.depth)
+
+    def compute_output_shape(self, input_shape):
+        if isinstance(input_shape, list):
+            input_shape = input_shape[0]
+        return tuple(input_shape[:-1]) + (self.depth,)
+
+
+class CastLabels(Layer):
+    """Remove the channel axis of a label map of shape [batchsize, shape_dim1, ..., shape_dimn, 1], and cast it to the
+    given type (int32 by default).
+
+    :param out_type: (optional) type of the returned label map. Default is 'int32'.
+    :param remove_channel: (optional) whether to remove the channel axis. Default is True.
+    """
+
+    def __init__(self, out_type='int32', remove_channel=True, **kwargs):
+        self.out_type = out_type
+        self.remove_channel = remove_channel
+        super(CastLabels, self).__init__(**kwargs)
+
+    def get_config(self):
+        config = super().get_config()
+        config["out_type"] = self.out_type
+        config["remove_channel"] = self.remove_channel
+        return config
+
+    def call(self, inputs, **kwargs):
+        if self.remove_channel:
+            inputs = inputs[..., 0]
+        return tf.cast(inputs, dtype=self.out_type)
+
+    def compute_output_shape(self, input_shape):
+        return tuple(input_shape[:-1]) if self.remove_channel else input_shape
+
+
 class PadAroundCentre(Layer):
     """Pad the input tensor to the specified shape with the given value.
     The input tensor is expected to have shape [batchsize, shape_dim1, ..., shape_dimn, channel].
@@ -2049,3 +2151,61 @@ class RandomDilationErosion(Layer):
 
     def compute_output_shape(self, input_shape):
         return input_shape
+
+
+class RandomBoxDilationErosion(RandomDilationErosion):
+    """
+    Same as RandomDilationErosion, but with a cubic structuring element of size 2*factor+1 instead of a ball of radius
+    factor. Because the cube is separable, the dilation is obtained by successive 1D max-pooling along each axis
+    (and the erosion by dilating the background), which is much cheaper than the n-dimensional convolutions of
+    RandomDilationErosion for large factors. Also, all the elements of the batch are processed at once.
+    The parameters are the same as for RandomDilationErosion.
+    """
+
+    def call(self, inputs, **kwargs):
+
+        # sample probability of applying operation. If random negative is erosion and positive is dilation
+        batchsize = tf.split(tf.shape(inputs), [1, -1])[0]
+        shape = tf.concat([batchsize, tf.ones([self.n_dims + 1], dtype='int32')], axis=0)
+        if self.operation == 'dilation':
+            prob = tf.random.uniform(shape, 0, 1)
+        elif self.operation == 'erosion':
+            prob = tf.random.uniform(shape, -1, 0)
+        elif self.operation == 'random':
+            prob = tf.random.uniform(shape, -1, 1)
+        else:
+            raise ValueError("operation should either be 'dilation' 'erosion' or 'random', had %s" % self.operation)
+        dilate = K.greater(prob, 1 - self.prob + 0.001)
+        erode = K.less(prob, - (1 - self.prob + 0.001))
+
+        # sample factors
+        if self.min_factor == self.max_factor:
+            factors = [self.min_factor]
+            factor = self.min_factor * tf.ones(shape, dtype='int32')
+        else:
+            factors = list(range(self.min_factor, max(self.max_factor, self.max_factor_dilate)))
+            factor = tf.random.uniform(shape, minval=self.min_factor, maxval=self.max_factor, dtype='int32')
+            if (self.max_factor != self.max_factor_dilate) & (self.operation == 'random'):
+                factor_dilate = tf.random.uniform(shape, self.min_factor, self.max_factor_dilate, dtype='int32')
+                factor = tf.where(erode, factor, factor_dilate)
+
+        # dilate or erode the input mask with each possible factor, and keep the results matching the sampled ones
+        mask = tf.cast(tf.cast(inputs, dtype='bool'), dtype='float32')
+        new_mask = mask
+        for f in factors:
+            new_mask = tf.where(tf.logical_and(tf.equal(factor, f), dilate), self._box_dilation(mask, f), new_mask)
+            new_mask = tf.where(tf.logical_and(tf.equal(factor, f), erode), 1 - self._box_dilation(1 - mask, f),
+                                new_mask)
+        mask = tf.cast(new_mask, 'bool')
+
+        if self.return_mask:
+            return mask
+        else:
+            return inputs * tf.cast(mask, dtype=inputs.dtype)
+
+    def _box_dilation(self, mask, factor):
+        for i in range(self.n_dims):
+            ksize = [1] * self.n_dims
+            ksize[i] = 2 * factor + 1
+            mask = tf.nn.max_pool(mask, ksize=ksize, strides=1, padding='SAME')
+        return mask